@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+config.py – shared config loading for QueueCTL with an mtime-based cache
+Hot paths (enqueue, worker startup) call load_config repeatedly; the cache
+skips the open+parse entirely until config.json actually changes on disk.
+"""
+
+import json
+import mmap
+import os
+
+CONFIG_PATH = os.path.join(os.getcwd(), "config.json")
+
+DEFAULT_CONFIG = {"max_retries": 3, "backoff_base": 2}
+
+# cache keyed on file mtime so repeat reads cost one stat() instead of open+parse
+_cfg_cache = {"mtime": 0, "data": None}
+
+# read-only mmap of config.json, remapped only when the file changes
+_cfg_mm = None
+
+
+def _read_config_bytes(size: int) -> bytes:
+    """Map config.json read-only and return its contents, falling back to a
+    plain read where mmap isn't possible (e.g. empty file)."""
+    global _cfg_mm
+    if _cfg_mm is not None:
+        _cfg_mm.close()
+        _cfg_mm = None
+    fd = os.open(CONFIG_PATH, os.O_RDONLY)
+    try:
+        if size > 0:
+            _cfg_mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            return bytes(_cfg_mm)
+        return b"{}"
+    except (OSError, ValueError):
+        with open(CONFIG_PATH, "rb") as f:
+            return f.read()
+    finally:
+        os.close(fd)
+
+
+def load_config(create_missing: bool = False):
+    """Return the config dict, re-reading config.json only when its mtime changes."""
+    try:
+        st = os.stat(CONFIG_PATH)
+    except OSError:
+        default = dict(DEFAULT_CONFIG)
+        if create_missing:
+            save_config(default)
+        return default
+    if _cfg_cache["data"] is None or _cfg_cache["mtime"] != st.st_mtime_ns:
+        _cfg_cache["data"] = json.loads(_read_config_bytes(st.st_size))
+        _cfg_cache["mtime"] = st.st_mtime_ns
+    return _cfg_cache["data"]
+
+
+def save_config(cfg):
+    """Write config.json and invalidate the cache."""
+    with open(CONFIG_PATH, "w") as f:
+        json.dump(cfg, f, indent=2)
+    _cfg_cache["data"] = None
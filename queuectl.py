@@ -9,42 +9,82 @@ import os
 import sys
 import uuid
 import time
-from storage import Storage
+from storage import Storage, signal_wakeup
 from worker import start_workers, stop_workers
-from datetime import datetime, timezone
+from config import load_config as _load_config, save_config
 
-CONFIG_PATH = os.path.join(os.getcwd(), "config.json")
+# orjson is 2-5x faster than stdlib json on both parse and dump; used for the
+# hot paths (payload parsing, job listing) when available. Config I/O stays on
+# stdlib json — it's a cold path and keeps the indented on-disk format.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def _json_dumps(obj):
+    return orjson.dumps(obj).decode() if orjson is not None else json.dumps(obj)
 
 def load_config():
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, "r") as f:
-            return json.load(f)
-    default = {"max_retries": 3, "backoff_base": 2}
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(default, f, indent=2)
-    return default
+    return _load_config(create_missing=True)
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _fmt_ts(ms):
+    """Unix ms to ISO-8601 UTC via strftime — one string allocation instead of
+    building a datetime object with tzinfo per value."""
+    sec, rem = divmod(int(ms), 1000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)) + f".{rem:03d}000+00:00"
+
+def _fmt_job(job):
+    """Format a job row for display: unix-ms timestamps back to ISO-8601."""
+    job = job._asdict() if hasattr(job, "_asdict") else dict(job)
+    for col in ("created_at", "updated_at"):
+        ts = job.get(col)
+        if isinstance(ts, (int, float)):
+            job[col] = _fmt_ts(ts)
+    return job
+
+def _normalize_job(job, now, default_retries):
+    # enforce required fields
+    job['id'] = job.get("id", f"job-{uuid.uuid4().hex[:8]}")
+    job['command'] = job.get("command", "")
+    job['state'] = job.get("state", "pending")
+    job['attempts'] = int(job.get("attempts", 0))
+    job['max_retries'] = int(job.get("max_retries", default_retries))
+    job['use_shell'] = bool(job.get("use_shell", False))
+    job['created_at'] = job.get("created_at", now)
+    job['updated_at'] = job.get("updated_at", now)
+    return job
 
 def cmd_enqueue(args):
     storage = Storage()
     raw = args.payload
     try:
-        job = json.loads(raw)
+        payload = _json_loads(raw)
     except Exception:
         print("Invalid JSON payload")
         return
-    # enforce required fields
-    job_id = job.get("id", f"job-{uuid.uuid4().hex[:8]}")
-    job['id'] = job_id
-    job['command'] = job.get("command", "")
-    job['state'] = job.get("state", "pending")
-    job['attempts'] = int(job.get("attempts", 0))
-    job['max_retries'] = int(job.get("max_retries", load_config().get("max_retries", 3)))
-    now = datetime.now(timezone.utc).isoformat()
-    job['created_at'] = job.get("created_at", now)
-    job['updated_at'] = job.get("updated_at", now)
+    now = _now_ms()
+    default_retries = load_config().get("max_retries", 3)
+    if isinstance(payload, list):
+        # bulk enqueue: all rows in one transaction
+        jobs = [_normalize_job(job, now, default_retries) for job in payload]
+        try:
+            storage.add_jobs(jobs)
+            signal_wakeup()
+            print(f"Enqueued {len(jobs)} jobs")
+        except Exception as e:
+            print(f"Failed to enqueue batch: {e}")
+        return
+    job = _normalize_job(payload, now, default_retries)
     try:
         storage.add_job(job)
-        print(f"Enqueued job {job_id}")
+        signal_wakeup()
+        print(f"Enqueued job {job['id']}")
     except Exception as e:
         print(f"Failed to enqueue: {e}")
 
@@ -73,41 +113,40 @@ def cmd_status(args):
     else:
         print("No worker manager pidfile found (workers may be running in foreground)")
 
+def _dump_jobs(jobs):
+    """Stream jobs to stdout as one JSON array; returns the number written."""
+    it = iter(jobs)
+    try:
+        first = next(it)
+    except StopIteration:
+        return 0
+    out = sys.stdout
+    out.write("[\n ")
+    out.write(_json_dumps(_fmt_job(first)))
+    n = 1
+    for j in it:
+        out.write(",\n ")
+        out.write(_json_dumps(_fmt_job(j)))
+        n += 1
+    out.write("\n]\n")
+    return n
+
 def cmd_list(args):
     storage = Storage()
-    jobs = storage.list_jobs(state=args.state)
-    if not jobs:
+    if not _dump_jobs(storage.iter_jobs(state=args.state)):
         print("No jobs")
-        return
-    for j in jobs:
-        print(json.dumps(j, indent=2))
 
 def cmd_dlq_list(args):
     storage = Storage()
-    dlq_jobs = storage.list_jobs(state='dead')
-    if not dlq_jobs:
+    if not _dump_jobs(storage.iter_jobs(state='dead')):
         print("DLQ empty")
-        return
-    for j in dlq_jobs:
-        print(json.dumps(j, indent=2))
 
 def cmd_dlq_retry(args):
     storage = Storage()
-    job = storage.get_job(args.job_id)
-    if not job:
-        print("Job not found")
-        return
-    if job['state'] != 'dead':
-        print("Job is not in DLQ (state != dead)")
+    if not storage.requeue_from_dlq(args.job_id):
+        print("Job not found or not in DLQ (state != dead)")
         return
-    # reset attempts and state
-    storage.move_to_state(job_id=args.job_id, new_state='pending', last_error=None)
-    # reset attempts to 0
-    conn = storage._conn()
-    now = datetime.now(timezone.utc).isoformat()
-    with conn:
-        conn.execute("UPDATE jobs SET attempts=0, updated_at=? WHERE id=?", (now, args.job_id))
-    conn.close()
+    signal_wakeup()
     print(f"Re-queued job {args.job_id} from DLQ")
 
 def cmd_config_set(args):
@@ -125,8 +164,7 @@ def cmd_config_set(args):
         # keep string
         pass
     cfg[key] = val
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(cfg, f, indent=2)
+    save_config(cfg)
     print(f"Set config {key}={val}")
 
 def cmd_config_get(args):
@@ -1,181 +1,397 @@
 #!/usr/bin/env python3
 """
 storage.py – SQLite-based job storage for QueueCTL (Windows-safe)
-Each DB call opens and closes its own connection, so it works with multiprocessing spawn mode.
+Each Storage instance holds one cached connection; workers are separate
+processes, so this stays multiprocessing-spawn-safe.
 """
 
+import atexit
 import sqlite3
 import os
-from datetime import datetime, timezone
+import time
+from collections import namedtuple
 from typing import Optional, List, Dict, Any
 
 DB_PATH = os.path.join(os.getcwd(), "queuectl.db")
 
+# Sidecar file touched on enqueue so idle workers wake up without waiting
+# out their full poll interval (works across unrelated processes and OSes).
+WAKEUP_PATH = os.path.join(os.getcwd(), "queuectl.wakeup")
 
-def _now_iso():
-    return datetime.now(timezone.utc).isoformat()
+# Bumped whenever _ensure_db's DDL/migrations change; stored in the DB via
+# PRAGMA user_version so an up-to-date file skips schema setup entirely.
+SCHEMA_VERSION = 3
+
+# DB paths whose schema has already been set up in this process
+_initialized_dbs = set()
+
+
+def signal_wakeup():
+    """Touch the wakeup file so sleeping workers re-poll immediately (best-effort)."""
+    try:
+        with open(WAKEUP_PATH, "a"):
+            os.utime(WAKEUP_PATH, None)
+    except OSError:
+        pass  # workers still wake at poll_interval without it
+
+
+# Explicit column list shared by SELECTs and the Job namedtuple; rows come
+# back as lightweight tuples instead of per-row dict(Row) rehashing.
+_JOB_COLS = ("id, command, state, attempts, max_retries, created_at, updated_at, "
+             "last_error, next_run_at, use_shell")
+
+Job = namedtuple("Job", [c.strip() for c in _JOB_COLS.split(",")])
+
+# Narrow row for the claim path: workers only need these five fields.
+ClaimedJob = namedtuple("ClaimedJob", ["id", "command", "attempts", "max_retries", "use_shell"])
+
+
+# SQL text lives in module-level constants: sqlite3 keys its compiled-statement
+# cache on string identity, so reusing the same objects means each statement is
+# parsed and planned once per connection.
+_SQL_INSERT = """
+    INSERT INTO jobs (id, command, state, attempts, max_retries,
+                      created_at, updated_at, last_error, use_shell)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_CLAIM = """
+    UPDATE jobs
+    SET state = 'processing', attempts = attempts + 1, updated_at = ?
+    WHERE id = (SELECT id FROM jobs
+                WHERE state IN ('pending','failed') AND next_run_at <= ?
+                ORDER BY next_run_at, created_at LIMIT 1)
+    RETURNING id, command, attempts, max_retries, use_shell
+"""
+
+_SQL_GET = f"SELECT {_JOB_COLS} FROM jobs WHERE id = ?"
+_SQL_LIST_BY_STATE = f"SELECT {_JOB_COLS} FROM jobs WHERE state = ? ORDER BY created_at"
+_SQL_LIST_ALL = f"SELECT {_JOB_COLS} FROM jobs ORDER BY created_at"
+_SQL_SUMMARY = "SELECT state, COUNT(*) AS cnt FROM jobs GROUP BY state"
+_SQL_MOVE_STATE = "UPDATE jobs SET state=?, updated_at=?, last_error=? WHERE id=?"
+_SQL_MARK_DONE = "UPDATE jobs SET state='completed', updated_at=?, last_error=NULL WHERE id=?"
+_SQL_MARK_DEAD = "UPDATE jobs SET state='dead', updated_at=?, last_error=? WHERE id=?"
+_SQL_MARK_FAILED = "UPDATE jobs SET state='failed', updated_at=?, last_error=?, next_run_at=? WHERE id=?"
+_SQL_REQUEUE_DLQ = """
+    UPDATE jobs SET state='pending', attempts=0, last_error=NULL, next_run_at=0, updated_at=?
+    WHERE id=? AND state='dead' RETURNING id
+"""
+
+# Column definitions shared by initial creation and the migration rebuild.
+_JOBS_TABLE_DDL = """(
+    id TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_retries INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    last_error TEXT,
+    next_run_at INTEGER NOT NULL DEFAULT 0,
+    use_shell INTEGER NOT NULL DEFAULT 0
+)"""
+
+
+def _now_ms():
+    """Current time as unix milliseconds; integers index tighter and compare
+    cheaper than the ISO-8601 strings the schema used to store."""
+    return int(time.time() * 1000)
 
 
 class Storage:
     def __init__(self, db_path: str = DB_PATH):
         self.db_path = db_path
+        self._c = None  # lazily opened, cached connection
         self._ensure_db()
+        atexit.register(self.close)
 
     # ------------------------------------------------------------------ #
     def _conn(self):
-        """Return a *new* open SQLite connection each call."""
-        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """Return this instance's cached SQLite connection, opening it on first use.
+
+        Each worker is its own process, so one long-lived connection per
+        Storage is spawn-safe and avoids re-paying open/close plus WAL/SHM
+        setup on every call.
+        """
+        if self._c is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                   cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            self._apply_pragmas(conn)
+            self._c = conn
+        return self._c
+
+    # ------------------------------------------------------------------ #
+    def close(self):
+        """Close the cached connection (safe to call more than once)."""
+        if self._c is not None:
+            try:
+                self._c.close()
+            except sqlite3.ProgrammingError:
+                # connection belongs to another thread (atexit runs on the
+                # main thread); process exit reclaims it anyway
+                pass
+            self._c = None
+
+    # ------------------------------------------------------------------ #
+    @staticmethod
+    def _apply_pragmas(conn):
+        """Apply per-connection pragmas (journal_mode=WAL is persistent, the rest are not)."""
+        conn.execute("PRAGMA synchronous=NORMAL")     # WAL-safe; halves fsyncs vs FULL
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")      # 64 MiB page cache
+        conn.execute("PRAGMA mmap_size=268435456")    # 256 MiB
+        # higher threshold amortizes checkpoint cost; the maintenance thread
+        # truncates the WAL on its own schedule anyway
+        conn.execute("PRAGMA wal_autocheckpoint=2000")
+
+    # ------------------------------------------------------------------ #
+    def maintenance(self):
+        """Periodic WAL truncation plus planner stats refresh.
+
+        wal_checkpoint(TRUNCATE) keeps the WAL from growing until a random
+        writer pays the full checkpoint cost; PRAGMA optimize keeps the
+        planner stats tracking the shifting state distribution.
+        """
+        conn = self._conn()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        conn.execute("PRAGMA optimize")
 
     # ------------------------------------------------------------------ #
     def _ensure_db(self):
-        """Create DB and tables if they don’t exist."""
-        conn = sqlite3.connect(self.db_path)
+        """Create DB and tables if they don’t exist (idempotent)."""
+        if self.db_path in _initialized_dbs:
+            return
+        conn = sqlite3.connect(self.db_path, timeout=30)
         c = conn.cursor()
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS jobs (
-            id TEXT PRIMARY KEY,
-            command TEXT NOT NULL,
-            state TEXT NOT NULL,
-            attempts INTEGER NOT NULL,
-            max_retries INTEGER NOT NULL,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL,
-            last_error TEXT
-        )
-        """)
-        c.execute("CREATE INDEX IF NOT EXISTS idx_state ON jobs(state)")
-        c.execute("PRAGMA journal_mode=WAL;")  # allow concurrent readers/writers
-        conn.commit()
+        if c.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            # schema is current: skip the DDL below so startup needs no
+            # write transaction (matters when many workers start under load)
+            conn.close()
+            _initialized_dbs.add(self.db_path)
+            return
+        # One transaction around the whole migration: a crash mid-rebuild
+        # must leave the old schema intact, never a renamed/half-copied
+        # table. BEGIN IMMEDIATE also serializes concurrent first starts
+        # (e.g. the maintenance thread racing a forked worker).
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            # re-check under the write lock: another process may have
+            # finished this migration while we waited for it
+            if c.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._migrate(c)
+                c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        # journal_mode can't change inside a transaction; WAL is persistent
+        c.execute("PRAGMA journal_mode=WAL;").fetchone()  # allow concurrent readers/writers
         conn.close()
+        _initialized_dbs.add(self.db_path)
+
+    # ------------------------------------------------------------------ #
+    @staticmethod
+    def _migrate(c):
+        """Bring the jobs table to the current schema (runs inside one transaction)."""
+        c.execute("CREATE TABLE IF NOT EXISTS jobs " + _JOBS_TABLE_DDL)
+        # migrate DBs created before retry backoff moved into the claim query
+        info = {r[1]: (r[2] or "").upper() for r in c.execute("PRAGMA table_info(jobs)")}
+        if "next_run_at" not in info:
+            c.execute("ALTER TABLE jobs ADD COLUMN next_run_at INTEGER NOT NULL DEFAULT 0")
+        if "use_shell" not in info:
+            c.execute("ALTER TABLE jobs ADD COLUMN use_shell INTEGER NOT NULL DEFAULT 0")
+        # Rebuild tables whose timestamp columns still declare TEXT: an
+        # in-place UPDATE can't change the declared type, and TEXT affinity
+        # coerces every stored integer right back into a string.
+        if info.get("created_at", "INTEGER") != "INTEGER":
+            # ISO-8601 strings convert via strftime; values an earlier
+            # in-place conversion left as numeric strings fall through to
+            # the plain CAST (strftime returns NULL for them).
+            ts = ("COALESCE(CAST(strftime('%s', {0}) AS INTEGER) * 1000, "
+                  "CAST({0} AS INTEGER))")
+            c.execute("ALTER TABLE jobs RENAME TO jobs_old")
+            c.execute("CREATE TABLE jobs " + _JOBS_TABLE_DDL)
+            c.execute(
+                "INSERT INTO jobs SELECT id, command, state, attempts, max_retries, "
+                + ts.format("created_at") + ", " + ts.format("updated_at")
+                + ", last_error, next_run_at, use_shell FROM jobs_old"
+            )
+            c.execute("DROP TABLE jobs_old")
+        # Composite index serves both the state filter and the next_run_at
+        # range+ordering of the claim query; integer comparisons beat the old
+        # ISO-string created_at ordering and index tighter. Earlier indexes
+        # are covered by this one's prefix and dropped.
+        c.execute("DROP INDEX IF EXISTS idx_state")
+        c.execute("DROP INDEX IF EXISTS idx_state_created")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_state_next_run ON jobs(state, next_run_at)")
+        c.execute("ANALYZE")
+
+    # ------------------------------------------------------------------ #
+    @staticmethod
+    def _job_row(job: Dict[str, Any], now: int):
+        return (
+            job["id"],
+            job["command"],
+            job.get("state", "pending"),
+            job.get("attempts", 0),
+            job.get("max_retries", 3),
+            job.get("created_at", now),
+            job.get("updated_at", now),
+            job.get("last_error"),
+            1 if job.get("use_shell") else 0,
+        )
 
     # ------------------------------------------------------------------ #
     def add_job(self, job: Dict[str, Any]) -> None:
         conn = self._conn()
-        now = _now_iso()
+        conn.execute(_SQL_INSERT, self._job_row(job, _now_ms()))
+        conn.commit()
+
+    # ------------------------------------------------------------------ #
+    def add_jobs(self, jobs: List[Dict[str, Any]]) -> None:
+        """Insert many jobs inside one transaction.
+
+        A single BEGIN/COMMIT around executemany amortizes the per-commit
+        fsync across the whole batch instead of paying it once per row.
+        """
+        conn = self._conn()
+        now = _now_ms()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn.execute("""
-                INSERT INTO jobs (id, command, state, attempts, max_retries,
-                                  created_at, updated_at, last_error)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                job["id"],
-                job["command"],
-                job.get("state", "pending"),
-                job.get("attempts", 0),
-                job.get("max_retries", 3),
-                job.get("created_at", now),
-                job.get("updated_at", now),
-                job.get("last_error"),
-            ))
+            conn.executemany(_SQL_INSERT, [self._job_row(job, now) for job in jobs])
             conn.commit()
-        finally:
-            conn.close()
+        except Exception:
+            conn.rollback()
+            raise
 
     # ------------------------------------------------------------------ #
-    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+    def get_job(self, job_id: str) -> Optional[Job]:
         conn = self._conn()
-        try:
-            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
-            return dict(row) if row else None
-        finally:
-            conn.close()
+        row = conn.execute(_SQL_GET, (job_id,)).fetchone()
+        return Job(*row) if row else None
 
     # ------------------------------------------------------------------ #
-    def list_jobs(self, state: Optional[str] = None) -> List[Dict[str, Any]]:
+    def list_jobs(self, state: Optional[str] = None) -> List[Job]:
         conn = self._conn()
-        try:
-            if state:
-                rows = conn.execute(
-                    "SELECT * FROM jobs WHERE state = ? ORDER BY created_at", (state,)
-                ).fetchall()
-            else:
-                rows = conn.execute(
-                    "SELECT * FROM jobs ORDER BY created_at"
-                ).fetchall()
-            return [dict(r) for r in rows]
-        finally:
-            conn.close()
+        if state:
+            rows = conn.execute(_SQL_LIST_BY_STATE, (state,)).fetchall()
+        else:
+            rows = conn.execute(_SQL_LIST_ALL).fetchall()
+        return [Job(*r) for r in rows]
+
+    # ------------------------------------------------------------------ #
+    def iter_jobs(self, state: Optional[str] = None):
+        """Yield jobs one at a time instead of materializing the whole table.
+
+        Rows are pulled from SQLite in chunks of 512 via fetchmany, so
+        listing a large table costs one row's worth of Python objects at a
+        time rather than the full result set.
+        """
+        conn = self._conn()
+        if state:
+            cur = conn.execute(_SQL_LIST_BY_STATE, (state,))
+        else:
+            cur = conn.execute(_SQL_LIST_ALL)
+        cur.arraysize = 512
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                return
+            for r in rows:
+                yield Job(*r)
 
     # ------------------------------------------------------------------ #
     def summary(self) -> Dict[str, int]:
         conn = self._conn()
-        try:
-            cur = conn.execute("SELECT state, COUNT(*) AS cnt FROM jobs GROUP BY state").fetchall()
-            return {r["state"]: r["cnt"] for r in cur}
-        finally:
-            conn.close()
+        cur = conn.execute(_SQL_SUMMARY).fetchall()
+        return {r["state"]: r["cnt"] for r in cur}
 
     # ------------------------------------------------------------------ #
     def move_to_state(self, job_id: str, new_state: str, last_error: Optional[str] = None):
         conn = self._conn()
-        now = _now_iso()
+        now = _now_ms()
+        conn.execute(_SQL_MOVE_STATE, (new_state, now, last_error, job_id))
+        conn.commit()
+
+    # ------------------------------------------------------------------ #
+    def claim_next_job(self) -> Optional[ClaimedJob]:
+        """Atomically claim the oldest pending/failed job and mark it processing.
+
+        One UPDATE ... RETURNING statement (SQLite 3.35+) replaces the old
+        fetch-then-lock pair, so two workers can never grab the same row.
+        BEGIN IMMEDIATE takes the write lock up front, avoiding deadlocks
+        from a later read→write lock upgrade.
+        """
+        conn = self._conn()
+        now = _now_ms()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn.execute(
-                "UPDATE jobs SET state=?, updated_at=?, last_error=? WHERE id=?",
-                (new_state, now, last_error, job_id),
-            )
+            row = conn.execute(_SQL_CLAIM, (now, now)).fetchone()
             conn.commit()
-        finally:
-            conn.close()
+        except Exception:
+            conn.rollback()
+            raise
+        return ClaimedJob(*row) if row else None
 
     # ------------------------------------------------------------------ #
-    def increment_attempts_and_lock(self, job_id: str) -> Optional[Dict[str, Any]]:
-        """Increment attempts and mark job as processing if it’s pending/failed."""
+    def update_job_after_execution_many(self, results: List[tuple]) -> None:
+        """Apply a batch of execution results in one transaction.
+
+        `results` holds (job_id, success, attempts, max_retries, err,
+        retry_delay_ms) tuples as passed to update_job_after_execution.
+        One BEGIN IMMEDIATE/COMMIT amortizes the commit fsync across the
+        whole batch.
+        """
         conn = self._conn()
-        now = _now_iso()
+        now = _now_ms()
+        done, dead, failed = [], [], []
+        for job_id, success, attempts, max_retries, err, retry_delay_ms in results:
+            if success:
+                done.append((now, job_id))
+            elif attempts >= max_retries:
+                dead.append((now, err, job_id))
+            else:
+                failed.append((now, err, now + retry_delay_ms, job_id))
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            res = conn.execute("""
-                UPDATE jobs
-                SET attempts = attempts + 1, state = 'processing', updated_at = ?
-                WHERE id = ? AND state IN ('pending','failed')
-            """, (now, job_id))
-            if res.rowcount == 0:
-                return None
-            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if done:
+                conn.executemany(_SQL_MARK_DONE, done)
+            if dead:
+                conn.executemany(_SQL_MARK_DEAD, dead)
+            if failed:
+                conn.executemany(_SQL_MARK_FAILED, failed)
             conn.commit()
-            return dict(row)
-        finally:
-            conn.close()
+        except Exception:
+            conn.rollback()
+            raise
 
     # ------------------------------------------------------------------ #
-    def fetch_and_lock_next_job(self) -> Optional[Dict[str, Any]]:
-        """Return one job ready for processing (pending/failed)."""
+    def requeue_from_dlq(self, job_id: str) -> bool:
+        """Move a dead job back to pending with attempts reset, in one statement.
+
+        RETURNING doubles as the found-and-was-dead check, so callers need
+        neither a prior get_job nor a second UPDATE.
+        """
         conn = self._conn()
-        try:
-            row = conn.execute("""
-                SELECT * FROM jobs
-                WHERE state IN ('pending','failed')
-                ORDER BY created_at LIMIT 1
-            """).fetchone()
-            return dict(row) if row else None
-        finally:
-            conn.close()
+        row = conn.execute(_SQL_REQUEUE_DLQ, (_now_ms(), job_id)).fetchone()
+        conn.commit()
+        return row is not None
 
     # ------------------------------------------------------------------ #
     def update_job_after_execution(
-        self, job_id: str, success: bool, attempts: int, max_retries: int, err: Optional[str] = None
+        self, job_id: str, success: bool, attempts: int, max_retries: int,
+        err: Optional[str] = None, retry_delay_ms: int = 0
     ):
         conn = self._conn()
-        now = _now_iso()
-        try:
-            if success:
-                conn.execute(
-                    "UPDATE jobs SET state='completed', updated_at=?, last_error=NULL WHERE id=?",
-                    (now, job_id),
-                )
+        now = _now_ms()
+        if success:
+            conn.execute(_SQL_MARK_DONE, (now, job_id))
+        else:
+            if attempts >= max_retries:
+                conn.execute(_SQL_MARK_DEAD, (now, err, job_id))
             else:
-                if attempts >= max_retries:
-                    conn.execute(
-                        "UPDATE jobs SET state='dead', updated_at=?, last_error=? WHERE id=?",
-                        (now, err, job_id),
-                    )
-                else:
-                    conn.execute(
-                        "UPDATE jobs SET state='failed', updated_at=?, last_error=? WHERE id=?",
-                        (now, err, job_id),
-                    )
-            conn.commit()
-        finally:
-            conn.close()
+                # job stays claimable but is skipped until its backoff expires
+                conn.execute(_SQL_MARK_FAILED, (now, err, _now_ms() + retry_delay_ms, job_id))
+        conn.commit()
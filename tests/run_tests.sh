@@ -45,7 +45,7 @@ echo "✅ TEST 4: Invalid commands fail gracefully"
 $PY $CLI enqueue '{"id":"job_badcmd","command":"not_a_real_command_x"}'
 $PY $CLI worker start --count 1 &
 W_PID=$!
-sleep 6
+sleep 10
 kill -SIGINT $W_PID || true
 $PY $CLI dlq list | grep job_badcmd
 
@@ -3,27 +3,102 @@
 worker.py - Windows-safe worker loop for queuectl
 """
 
+import asyncio
 import os
+import shlex
 import signal
 import subprocess
+import threading
 import time
-import json
-from multiprocessing import Process, current_process
-from math import pow
+from multiprocessing import Process, Queue, current_process
+from queue import Empty, Full
 from typing import Optional
-from storage import Storage
+from storage import Storage, WAKEUP_PATH
+from config import load_config
+
+# uvloop gives batched, lower-overhead I/O submission on Linux; plain asyncio
+# is the portable fallback.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 PIDFILE = os.path.join(os.getcwd(), "queuectl_worker.pid")
-CONFIG_PATH = os.path.join(os.getcwd(), "config.json")
+
+MAINTENANCE_INTERVAL = 15 * 60  # seconds between WAL checkpoint + PRAGMA optimize runs
+
+DEFAULT_CONCURRENCY = 4  # concurrent subprocesses per worker (config key "concurrency")
 
 _running = True
 
 
-def load_config():
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, "r") as f:
-            return json.load(f)
-    return {"max_retries": 3, "backoff_base": 2}
+# Commands containing these need a real shell to interpret them.
+_SHELL_CHARS = ("|", ">", "<", "&", ";", "$", "`", "~", "*", "?")
+
+
+def _needs_shell(cmd: str) -> bool:
+    if not cmd.strip():
+        return True  # sh -c '' is the historic no-op; exec has nothing to run
+    if any(ch in cmd for ch in _SHELL_CHARS):
+        return True
+    return "=" in cmd.split(None, 1)[0]  # env-assignment prefix (FOO=bar cmd)
+
+
+def _run_command(cmd: str, use_shell: bool = False) -> "subprocess.CompletedProcess":
+    """Run a job command, forking /bin/sh only when shell features are used.
+
+    Plain commands go through shlex.split + shell=False, saving one
+    fork+exec per job (subprocess then uses posix_spawn on Linux).
+    close_fds=False skips the FD-closing pass; the worker only holds the
+    SQLite descriptor. A job can force the shell via its use_shell field
+    when the heuristic misses. Windows keeps shell=True since cmd.exe
+    parsing differs from shlex.
+    """
+    if os.name == "nt" or use_shell or _needs_shell(cmd):
+        return subprocess.run(cmd, shell=True)
+    return subprocess.run(shlex.split(cmd), shell=False, close_fds=False)
+
+
+def _execute(cmd: str, use_shell: bool = False):
+    """Run a command and return (success, err)."""
+    try:
+        proc = _run_command(cmd, use_shell)
+        if proc.returncode != 0:
+            return False, f"exit_code={proc.returncode}"
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+
+def _wakeup_mtime():
+    try:
+        return os.stat(WAKEUP_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _wait_for_wakeup(timeout: float):
+    """Sleep up to `timeout` seconds, returning early if an enqueue touches the wakeup file.
+
+    The file mtime is polled with exponential backoff starting at 10ms, so a
+    fresh job is picked up almost immediately while an idle queue costs only a
+    few stat() calls per second. Portable to Windows, unlike signals or FIFOs.
+    """
+    seen = _wakeup_mtime()
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while _running:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(delay, remaining))
+        if _wakeup_mtime() != seen:
+            return
+        delay = min(delay * 2, 0.2)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
 
 
 def _handle_sigint(signum, frame):
@@ -32,87 +107,283 @@ def _handle_sigint(signum, frame):
     print(f"[{current_process().name}] Received shutdown signal, finishing current job and exiting...")
 
 
-def run_worker_loop(worker_id: int, poll_interval: float = 1.0):
-    """
-    Windows-safe worker loop — creates fresh SQLite connections for each operation.
-    """
-    signal.signal(signal.SIGINT, _handle_sigint)
-    signal.signal(signal.SIGTERM, _handle_sigint)
+async def _execute_async(cmd: str, use_shell: bool = False):
+    """Async twin of _execute: spawn without blocking the event loop."""
+    try:
+        if os.name == "nt" or use_shell or _needs_shell(cmd):
+            proc = await asyncio.create_subprocess_shell(cmd)
+        else:
+            proc = await asyncio.create_subprocess_exec(*shlex.split(cmd), close_fds=False)
+        rc = await proc.wait()
+        if rc != 0:
+            return False, f"exit_code={rc}"
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
 
+async def _async_wait_for_wakeup(timeout: float):
+    """Async twin of _wait_for_wakeup; yields to running job tasks while idle."""
+    seen = _wakeup_mtime()
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while _running:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(delay, remaining))
+        if _wakeup_mtime() != seen:
+            return
+        delay = min(delay * 2, 0.2)
+
+
+async def _run_job(storage, job, worker_id, backoff_table, sem):
+    """Execute one claimed job and record its result; releases its semaphore slot."""
+    try:
+        print(f"[worker-{worker_id}] Processing job {job.id}: {job.command} (attempt {job.attempts})")
+        start_time = time.time()
+        success, err = await _execute_async(job.command, bool(job.use_shell))
+
+        backoff = backoff_table[min(job.attempts, len(backoff_table) - 1)]
+        try:
+            storage.update_job_after_execution(
+                job_id=job.id,
+                success=success,
+                attempts=job.attempts,
+                max_retries=job.max_retries,
+                err=err,
+                retry_delay_ms=backoff * 1000,
+            )
+        except Exception as e:
+            print(f"[worker-{worker_id}] Failed to update job {job.id}: {e}")
+            return
+
+        elapsed = time.time() - start_time
+        if success:
+            print(f"[worker-{worker_id}] Job {job.id} completed in {elapsed:.2f}s")
+        else:
+            if job.attempts >= job.max_retries:
+                print(f"[worker-{worker_id}] Job {job.id} failed permanently -> DLQ (attempts={job.attempts}) last_err={err}")
+            else:
+                # no sleep: the claim query skips this job until next_run_at,
+                # so the worker moves straight on to other pending jobs
+                print(f"[worker-{worker_id}] Job {job.id} failed (attempts={job.attempts}), will retry after ~{backoff}s: last_err={err}")
+    finally:
+        sem.release()
+
+
+async def _worker_main(worker_id: int, poll_interval: float):
+    """Claim jobs and supervise up to `concurrency` subprocesses at once.
+
+    The old loop blocked in subprocess.run between claims, leaving the
+    worker idle while a child ran. Here each claimed job becomes a task,
+    so one worker process keeps several children in flight; SQLite calls
+    stay synchronous — they are sub-millisecond against a local file.
+    """
     cfg = load_config()
     base = cfg.get("backoff_base", 2)
-    print(f"[worker-{worker_id}] started (pid={os.getpid()})")
+    # retry delays per attempt, precomputed once (same cap as the old sleep)
+    backoff_table = [min(int(base ** a), 5) for a in range(cfg.get("max_retries", 3) + 1)]
+    concurrency = int(cfg.get("concurrency", DEFAULT_CONCURRENCY))
+    print(f"[worker-{worker_id}] started (pid={os.getpid()}, concurrency={concurrency})")
+
+    storage = Storage()  # one cached connection for the whole loop
+    sem = asyncio.Semaphore(concurrency)
+    tasks = set()
 
     while _running:
+        await sem.acquire()  # wait for a free subprocess slot before claiming
+        if not _running:
+            sem.release()
+            break
+
         try:
-            storage = Storage()  # create fresh connection every loop
-            job = storage.fetch_and_lock_next_job()
+            job = storage.claim_next_job()
         except Exception as e:
-            print(f"[worker-{worker_id}] Error fetching job: {e}")
-            time.sleep(poll_interval)
+            sem.release()
+            print(f"[worker-{worker_id}] Error claiming job: {e}")
+            await asyncio.sleep(poll_interval)
             continue
 
         if not job:
-            time.sleep(poll_interval)
+            sem.release()
+            await _async_wait_for_wakeup(poll_interval)
             continue
 
-        job_id = job["id"]
-        attempts = job["attempts"]
-        max_retries = job["max_retries"]
+        task = asyncio.create_task(_run_job(storage, job, worker_id, backoff_table, sem))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
 
-        try:
-            locked = storage.increment_attempts_and_lock(job_id)
-        except Exception as e:
-            print(f"[worker-{worker_id}] Lock failed for job {job_id}: {e}")
-            continue
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"[worker-{worker_id}] exiting")
 
-        if not locked:
-            continue
 
-        cmd = job["command"]
-        print(f"[worker-{worker_id}] Processing job {job_id}: {cmd} (attempt {locked['attempts']})")
-        start_time = time.time()
+def run_worker_loop(worker_id: int, poll_interval: float = 1.0):
+    """
+    Windows-safe worker loop — one process supervising concurrent job subprocesses.
+    """
+    signal.signal(signal.SIGINT, _handle_sigint)
+    signal.signal(signal.SIGTERM, _handle_sigint)
 
-        success = True
-        err = None
-        try:
-            proc = subprocess.run(cmd, shell=True)
-            if proc.returncode != 0:
-                success = False
-                err = f"exit_code={proc.returncode}"
-        except Exception as e:
-            success = False
-            err = str(e)
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(_worker_main(worker_id, poll_interval))
 
-        attempts_after = locked["attempts"]
+
+def run_queue_worker(worker_id: int, job_q: Queue, result_q: Queue):
+    """Execute jobs handed out by the dispatcher; never touches the DB.
+
+    Receives ClaimedJob tuples on job_q (None is the shutdown sentinel) and
+    reports (job_id, success, attempts, max_retries, err) on result_q.
+    """
+    signal.signal(signal.SIGINT, _handle_sigint)
+    signal.signal(signal.SIGTERM, _handle_sigint)
+    print(f"[worker-{worker_id}] started (pid={os.getpid()})")
+
+    while _running:
         try:
-            storage.update_job_after_execution(
-                job_id=job_id,
-                success=success,
-                attempts=attempts_after,
-                max_retries=max_retries,
-                err=err,
-            )
-        except Exception as e:
-            print(f"[worker-{worker_id}] Failed to update job {job_id}: {e}")
+            job = job_q.get(timeout=0.5)
+        except Empty:
             continue
-        finally:
-            del storage  # ensure DB connection is closed before next loop
-
+        if job is None:
+            break
+        job_id, cmd, attempts, max_retries, use_shell = job
+        print(f"[worker-{worker_id}] Processing job {job_id}: {cmd} (attempt {attempts})")
+        start_time = time.time()
+        success, err = _execute(cmd, bool(use_shell))
         elapsed = time.time() - start_time
         if success:
             print(f"[worker-{worker_id}] Job {job_id} completed in {elapsed:.2f}s")
-        else:
-            if attempts_after >= max_retries:
-                print(f"[worker-{worker_id}] Job {job_id} failed permanently -> DLQ (attempts={attempts_after}) last_err={err}")
-            else:
-                backoff = pow(base, attempts_after)
-                print(f"[worker-{worker_id}] Job {job_id} failed (attempts={attempts_after}), will retry after ~{int(backoff)}s: last_err={err}")
-                time.sleep(min(backoff, 5))
+        result_q.put((job_id, success, attempts, max_retries, err))
 
     print(f"[worker-{worker_id}] exiting")
 
 
+# Result updates are coalesced into one transaction per batch: flush when 32
+# results are buffered, when the 50ms window closes, or when the queue goes
+# idle so a lone result isn't delayed.
+RESULT_BATCH_MAX = 32
+RESULT_BATCH_WINDOW = 0.05  # seconds
+
+
+def _drain_results(result_q, buf, backoff_table) -> int:
+    """Move all currently queued worker results into buf; returns how many moved."""
+    n = 0
+    while True:
+        try:
+            job_id, success, attempts, max_retries, err = result_q.get_nowait()
+        except Empty:
+            return n
+        backoff = backoff_table[min(attempts, len(backoff_table) - 1)]
+        buf.append((job_id, success, attempts, max_retries, err, backoff * 1000))
+        if not success:
+            if attempts >= max_retries:
+                print(f"[dispatcher] Job {job_id} failed permanently -> DLQ (attempts={attempts}) last_err={err}")
+            else:
+                print(f"[dispatcher] Job {job_id} failed (attempts={attempts}), will retry after ~{backoff}s: last_err={err}")
+        n += 1
+
+
+def _flush_results(storage, buf):
+    """Apply buffered results in one transaction and clear the buffer."""
+    if not buf:
+        return
+    try:
+        storage.update_job_after_execution_many(buf)
+    except Exception as e:
+        print(f"[dispatcher] Failed to update {len(buf)} job results: {e}")
+    buf.clear()
+
+
+def dispatcher_loop(count: int, poll_interval: float = 1.0):
+    """Single-writer dispatcher: claims jobs and hands them to executor workers.
+
+    Only this process writes to SQLite, so N workers no longer contend for
+    the write lock on every claim and status update. Jobs flow out through a
+    bounded Queue (2 per worker of headroom) and results flow back on a
+    second queue to be applied here.
+    """
+    # treat SIGTERM like Ctrl-C so `worker stop` drains and joins cleanly
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    job_q = Queue(maxsize=2 * count)
+    result_q = Queue()
+    procs = []
+    for i in range(count):
+        p = Process(target=run_queue_worker, args=(i + 1, job_q, result_q))
+        p.start()
+        procs.append(p)
+
+    # open the DB only after forking so children don't inherit the connection
+    storage = Storage()
+    cfg = load_config()
+    base = cfg.get("backoff_base", 2)
+    backoff_table = [min(int(base ** a), 5) for a in range(cfg.get("max_retries", 3) + 1)]
+    print(f"[dispatcher] started (pid={os.getpid()}, workers={count})")
+
+    result_buf = []
+    batch_started = 0.0
+    try:
+        while True:
+            dispatched = 0
+            while not job_q.full():
+                job = storage.claim_next_job()
+                if job is None:
+                    break
+                try:
+                    job_q.put(tuple(job), timeout=1)
+                except Full:
+                    break
+                dispatched += 1
+            if not result_buf:
+                batch_started = time.monotonic()
+            moved = _drain_results(result_q, result_buf, backoff_table)
+            if result_buf and (len(result_buf) >= RESULT_BATCH_MAX
+                               or time.monotonic() - batch_started >= RESULT_BATCH_WINDOW
+                               or (not dispatched and not moved)):
+                _flush_results(storage, result_buf)
+            if not dispatched and not moved:
+                _wait_for_wakeup(poll_interval)
+    except KeyboardInterrupt:
+        print("Shutdown requested. Stopping workers...")
+    finally:
+        for _ in procs:
+            try:
+                job_q.put(None, timeout=1)
+            except Full:
+                break
+        for p in procs:
+            p.join(timeout=5)
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        _drain_results(result_q, result_buf, backoff_table)
+        _flush_results(storage, result_buf)
+
+    print("[dispatcher] exiting")
+
+
+def _maintenance_loop():
+    """Run WAL checkpoint + PRAGMA optimize every MAINTENANCE_INTERVAL.
+
+    Daemon thread in the manager with its own connection, so maintenance
+    never stalls a worker's claim/update path.
+    """
+    storage = Storage()
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        try:
+            storage.maintenance()
+        except Exception as e:
+            print(f"[maintenance] {e}")
+        finally:
+            # drop the thread-owned connection between runs: sqlite3 won't
+            # let the main thread (atexit) or forked children close it
+            storage.close()
+
+
 def start_workers(count: int, daemon: bool = False):
     """Start multiple workers safely on Windows."""
     procs = []
@@ -128,6 +399,16 @@ def start_workers(count: int, daemon: bool = False):
             print(f"Worker manager started as daemon (pidfile={PIDFILE})")
             return
 
+    # one lightweight maintenance thread per manager, whichever model runs below
+    threading.Thread(target=_maintenance_loop, name="maintenance", daemon=True).start()
+
+    if count > 1:
+        # dispatcher model: one writer connection, workers only execute
+        dispatcher_loop(count)
+        return
+
+    # treat SIGTERM like Ctrl-C so the worker is terminated, not orphaned
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
     try:
         for i in range(count):
             p = Process(target=run_worker_loop, args=(i + 1,))